@@ -0,0 +1,126 @@
+"""
+Local benchmark database shared by the benchmark scripts.
+
+The benchmarks never touch the application database: they work on
+BENCH_DB_DATABASE (default catalog_bench) on the same server, created on
+demand. The base tables api.py expects are created here; everything else
+(indexes, triggers, sync_jobs) comes from api.apply_schema(), so the bench
+database always has the schema the code under test would deploy.
+"""
+
+import os
+import sys
+
+import psycopg2
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import api  # noqa: E402
+
+BENCH_DATABASE = os.getenv('BENCH_DB_DATABASE', 'catalog_bench')
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+# The database api.py is configured for; use_bench_database() repoints DB_CONFIG
+APP_DATABASE = api.DB_CONFIG['database']
+
+BASE_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS categories (
+        id SERIAL PRIMARY KEY,
+        name TEXT NOT NULL,
+        description TEXT,
+        created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+        updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS brands (
+        id SERIAL PRIMARY KEY,
+        name TEXT NOT NULL,
+        description TEXT,
+        logo_url TEXT,
+        created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+        updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS products (
+        id SERIAL PRIMARY KEY,
+        name TEXT NOT NULL,
+        description TEXT,
+        price NUMERIC(12, 2),
+        category_id INTEGER REFERENCES categories (id),
+        brand_id INTEGER REFERENCES brands (id),
+        specifications JSONB NOT NULL DEFAULT '{}',
+        image_url TEXT,
+        is_active BOOLEAN NOT NULL DEFAULT TRUE,
+        sku TEXT NOT NULL DEFAULT '',
+        stock_quantity INTEGER NOT NULL DEFAULT 0,
+        created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+        updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS sync_log (
+        id SERIAL PRIMARY KEY,
+        sync_type TEXT,
+        status TEXT,
+        details JSONB,
+        created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+    )
+    """,
+]
+
+
+def bench_config(database: str = BENCH_DATABASE) -> dict:
+    """api.DB_CONFIG (host, user, password) pointed at the bench database"""
+    if database == APP_DATABASE and os.getenv('BENCH_ALLOW_APP_DATABASE') != '1':
+        raise SystemExit(f"refusing to benchmark against the application database {database!r}; "
+                         f"set BENCH_DB_DATABASE or BENCH_ALLOW_APP_DATABASE=1")
+    return {**api.DB_CONFIG, 'database': database}
+
+
+def ensure_database(config: dict):
+    """CREATE DATABASE if it does not exist yet"""
+    try:
+        psycopg2.connect(**config).close()
+        return
+    except psycopg2.OperationalError as e:
+        if 'does not exist' not in str(e):
+            raise
+    conn = psycopg2.connect(**{**config, 'database': 'postgres'})
+    conn.autocommit = True
+    with conn.cursor() as cursor:
+        cursor.execute(f'CREATE DATABASE "{config["database"]}"')
+    conn.close()
+
+
+def prepare_schema(config: dict, reset: bool = False):
+    """
+    Base tables, then api.apply_schema() through the app's own pool.
+    reset=True empties the catalog first (bench database only).
+    """
+    ensure_database(config)
+    conn = psycopg2.connect(**config)
+    with conn.cursor() as cursor:
+        for statement in BASE_SCHEMA:
+            cursor.execute(statement)
+        if reset:
+            cursor.execute("TRUNCATE products, categories, brands, sync_log RESTART IDENTITY CASCADE")
+    conn.commit()
+    conn.close()
+
+    use_bench_database(config)
+    api.apply_schema()
+
+
+def use_bench_database(config: dict):
+    """
+    Point api at the bench database for calling its functions directly: DB_CONFIG
+    is updated in place, DB_DATABASE is exported for spawned worker processes
+    (parse and shard pools import api afresh), and the pool/executor are (re)opened.
+    """
+    api.DB_CONFIG.update(config)
+    os.environ['DB_DATABASE'] = config['database']
+    if api.db_pool is not None:
+        api.close_db_pool()
+    api.open_db_pool()
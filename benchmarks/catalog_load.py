@@ -0,0 +1,472 @@
+#!/usr/bin/env python3
+"""
+Read-API load test: seed a synthetic catalog, drive browsing mixes, compare runs.
+
+  seed     create/refill the bench database (BENCH_DB_DATABASE, default
+           catalog_bench) with categories, brands and products
+  run      run a browsing mix against a server for a fixed time and save
+           throughput and p50/p95/p99 per operation as JSON
+  compare  compare two result files and flag regressions (exit code 1)
+
+Usage:
+  python benchmarks/catalog_load.py seed --products 100000
+  python benchmarks/catalog_load.py run --spawn --mix browse --duration 60 --concurrency 32
+  python benchmarks/catalog_load.py run --url http://127.0.0.1:8000 --baseline benchmarks/results/before.json
+  python benchmarks/catalog_load.py compare before.json after.json --threshold 10
+
+--spawn starts `uvicorn api:app` on a free port against the bench database
+(extra uvicorn flags via --server-args). For numbers worth comparing, run
+the load generator on other cores than the server (taskset) or another host.
+"""
+
+import os
+import io
+import csv
+import sys
+import json
+import math
+import time
+import socket
+import random
+import asyncio
+import argparse
+import logging
+import subprocess
+from datetime import datetime, timedelta, timezone
+
+import httpx
+import psycopg2
+
+import bench_db
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# --- synthetic catalog ---
+
+PRODUCT_TYPES = ['Диван', 'Кресло', 'Стол', 'Стул', 'Шкаф', 'Комод', 'Кровать', 'Полка',
+                 'Светильник', 'Ковёр', 'Зеркало', 'Тумба', 'Люстра', 'Плед', 'Подушка', 'Ваза']
+MODELS = ['Oslo', 'Bergen', 'Nord', 'Loft', 'Milano', 'Verona', 'Classic', 'Provence',
+          'Scandi', 'Kyoto', 'Riga', 'Porto', 'Lund', 'Aalto', 'Siena', 'Bremen']
+MATERIALS = ['дуб', 'бук', 'сосна', 'ясень', 'металл', 'стекло', 'велюр', 'лён', 'кожа', 'ротанг']
+COLORS = ['белый', 'серый', 'бежевый', 'чёрный', 'графит', 'зелёный', 'синий', 'терракота']
+ROOMS = ['Гостиная', 'Спальня', 'Кухня', 'Прихожая', 'Детская', 'Кабинет', 'Ванная', 'Сад']
+BRAND_PARTS = ['Nord', 'Casa', 'Wood', 'Home', 'Loft', 'Art', 'Form', 'Line', 'Hygge', 'Moss']
+COUNTRIES = ['Россия', 'Беларусь', 'Италия', 'Польша', 'Швеция', 'Китай', 'Турция']
+
+PRODUCT_COPY_COLUMNS = ('name', 'description', 'price', 'category_id', 'brand_id', 'specifications',
+                        'image_url', 'is_active', 'sku', 'stock_quantity', 'created_at', 'updated_at')
+
+
+def skewed_choice(rng: random.Random, size: int) -> int:
+    """Index in [0, size) with a Zipf-like skew: a few categories/brands hold most products"""
+    return int(size * rng.random() ** 2)
+
+
+def product_row(rng: random.Random, i: int, categories: int, brands: int, now: datetime) -> tuple:
+    kind, model = rng.choice(PRODUCT_TYPES), rng.choice(MODELS)
+    material, color = rng.choice(MATERIALS), rng.choice(COLORS)
+    specifications = {
+        'material': material,
+        'color': color,
+        'dimensions': {'width': rng.randint(20, 240), 'height': rng.randint(10, 220), 'depth': rng.randint(10, 120)},
+        'weight_kg': round(rng.uniform(0.3, 120), 1),
+        'warranty_months': rng.choice([6, 12, 18, 24, 36]),
+        'country': rng.choice(COUNTRIES),
+        'features': rng.sample(['съёмный чехол', 'ящик для белья', 'регулировка высоты', 'LED', 'складной',
+                                'влагостойкий', 'антивандальная ткань'], rng.randint(0, 3)),
+    }
+    created = now - timedelta(seconds=rng.randint(0, 2 * 365 * 86400))
+    return (
+        f"{kind} {model} {material} {color} {i}",
+        f"{kind} {model} из материала «{material}», цвет {color}. "
+        f"Подходит для интерьера в стиле {rng.choice(MODELS)}; {rng.choice(ROOMS).lower()}.",
+        f"{rng.randint(5, 2000) * 50 - 10:.2f}",
+        skewed_choice(rng, categories) + 1,
+        skewed_choice(rng, brands) + 1,
+        json.dumps(specifications, ensure_ascii=False),
+        f"https://cdn.example.com/products/{i}.jpg",
+        't' if rng.random() > 0.05 else 'f',
+        f"BENCH-{i:08d}",
+        rng.randint(0, 500),
+        created.isoformat(),
+        (created + timedelta(seconds=rng.randint(0, 86400 * 30))).isoformat(),
+    )
+
+
+def copy_rows(cursor, table: str, columns, rows):
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    buffer.seek(0)
+    cursor.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)", buffer)
+
+
+def seed(args):
+    config = bench_db.bench_config(args.database)
+    started = time.perf_counter()
+    bench_db.prepare_schema(config, reset=True)
+    rng = random.Random(args.seed)
+    now = datetime.now(timezone.utc)
+
+    conn = psycopg2.connect(**config)
+    with conn.cursor() as cursor:
+        copy_rows(cursor, 'categories', ('name', 'description'), (
+            (f"{ROOMS[i % len(ROOMS)]} {i // len(ROOMS) + 1}", f"Товары для раздела {ROOMS[i % len(ROOMS)].lower()}")
+            for i in range(args.categories)
+        ))
+        copy_rows(cursor, 'brands', ('name', 'description', 'logo_url'), (
+            (f"{BRAND_PARTS[i % 10]}{BRAND_PARTS[i // 10 % 10].lower()}{'' if i < 100 else i // 100}",
+             f"Бренд {i}", f"https://cdn.example.com/brands/{i}.png")
+            for i in range(args.brands)
+        ))
+        conn.commit()
+
+        for start in range(0, args.products, args.batch):
+            end = min(start + args.batch, args.products)
+            copy_rows(cursor, 'products', PRODUCT_COPY_COLUMNS,
+                      (product_row(rng, i, args.categories, args.brands, now) for i in range(start, end)))
+            conn.commit()
+            print(f"\r{end}/{args.products} products", end='', flush=True)
+        print()
+    conn.autocommit = True
+    with conn.cursor() as cursor:
+        cursor.execute("VACUUM ANALYZE products")
+        cursor.execute("ANALYZE categories")
+        cursor.execute("ANALYZE brands")
+    conn.close()
+    print(f"seeded {config['database']}: {args.categories} categories, {args.brands} brands, "
+          f"{args.products} products in {time.perf_counter() - started:.1f}s")
+
+
+# --- browsing mixes ---
+
+PAGE_SIZE = 24
+SEARCH_TERMS = [*PRODUCT_TYPES, *MODELS, *MATERIALS, 'диван угловой', 'стол дуб', 'Oslo велюр', 'кресло кожа']
+
+# operation -> weight; every mix sums to 100
+MIXES = {
+    'browse': {'products_first_page': 15, 'products_category': 15, 'products_brand': 10, 'products_next_page': 15,
+               'product_detail': 25, 'categories': 5, 'brands': 5, 'search': 10},
+    'search': {'search': 50, 'products_search': 20, 'product_detail': 25, 'products_next_page': 5},
+    'detail': {'product_detail': 80, 'categories': 10, 'brands': 10},
+    'paging': {'products_next_page': 50, 'products_deep_offset': 20, 'products_first_page': 10,
+               'products_category': 20},
+}
+
+
+class Catalog:
+    """Names and ids discovered through the API, so any server can be targeted"""
+
+    def __init__(self, categories, brands, product_ids, total):
+        self.categories = categories
+        self.brands = brands
+        self.product_ids = product_ids
+        self.total = total
+
+    @classmethod
+    async def discover(cls, client: httpx.AsyncClient, pages: int = 20):
+        categories = [c['name'] for c in (await client.get('/api/categories')).json()]
+        brands = [b['name'] for b in (await client.get('/api/brands')).json()]
+        product_ids, cursor, total = [], None, None
+        for _ in range(pages):
+            params = {'limit': 100, 'count': 'estimated'}
+            if cursor:
+                params['cursor'] = cursor
+            page = (await client.get('/api/products', params=params)).json()
+            product_ids.extend(p['id'] for p in page['products'])
+            total = page['pagination']['total'] if total is None else total
+            cursor = page['pagination']['next_cursor']
+            if not cursor:
+                break
+        if not product_ids:
+            raise SystemExit("the catalog is empty; run `seed` first")
+        return cls(categories, brands, product_ids, total)
+
+
+class VirtualUser:
+    """One browsing session: picks operations by weight and follows its own next_cursor"""
+
+    def __init__(self, rng: random.Random, catalog: Catalog, mix: dict):
+        self.rng = rng
+        self.catalog = catalog
+        self.operations = list(mix)
+        self.weights = list(mix.values())
+        self.next_cursor = None
+        self.last_list = None
+
+    def next_request(self):
+        op = self.rng.choices(self.operations, self.weights)[0]
+        rng, catalog = self.rng, self.catalog
+        params = {'limit': PAGE_SIZE}
+        if op == 'products_first_page':
+            return op, '/api/products', params
+        if op == 'products_category':
+            return op, '/api/products', {**params, 'category': rng.choice(catalog.categories)}
+        if op == 'products_brand':
+            return op, '/api/products', {**params, 'brand': rng.choice(catalog.brands)}
+        if op == 'products_search':
+            return op, '/api/products', {**params, 'search': rng.choice(SEARCH_TERMS)}
+        if op == 'products_next_page':
+            if self.next_cursor:
+                return op, '/api/products', {**(self.last_list or params), 'cursor': self.next_cursor}
+            return op, '/api/products', params
+        if op == 'products_deep_offset':
+            pages = max(1, min((catalog.total or PAGE_SIZE) // PAGE_SIZE, 200))
+            return op, '/api/products', {**params, 'offset': rng.randrange(pages) * PAGE_SIZE}
+        if op == 'product_detail':
+            return op, f'/api/products/{rng.choice(catalog.product_ids)}', None
+        if op == 'categories':
+            return op, '/api/categories', None
+        if op == 'brands':
+            return op, '/api/brands', None
+        if op == 'search':
+            return op, '/api/search', {'q': rng.choice(SEARCH_TERMS), 'limit': 20}
+        raise ValueError(op)
+
+    def observe(self, path: str, params, response: httpx.Response):
+        if path == '/api/products' and response.status_code == 200:
+            self.next_cursor = response.json()['pagination']['next_cursor']
+            self.last_list = {k: v for k, v in params.items() if k != 'cursor'}
+
+
+def percentile(ordered, q: float) -> float:
+    """Nearest-rank percentile of a sorted list"""
+    return ordered[max(0, math.ceil(q / 100 * len(ordered)) - 1)]
+
+
+def summarize(latencies, errors: int, elapsed: float) -> dict:
+    ordered = sorted(latencies)
+    count = len(ordered)
+    if not count:
+        return {'requests': 0, 'errors': errors, 'rps': 0}
+    return {
+        'requests': count,
+        'errors': errors,
+        'rps': round(count / elapsed, 1),
+        'mean_ms': round(sum(ordered) / count * 1000, 2),
+        'p50_ms': round(percentile(ordered, 50) * 1000, 2),
+        'p95_ms': round(percentile(ordered, 95) * 1000, 2),
+        'p99_ms': round(percentile(ordered, 99) * 1000, 2),
+        'max_ms': round(ordered[-1] * 1000, 2),
+    }
+
+
+async def drive(url: str, mix_name: str, duration: float, warmup: float, concurrency: int, seed_value: int) -> dict:
+    mix = MIXES[mix_name]
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=30) as client:
+        catalog = await Catalog.discover(client)
+        samples = {op: [] for op in mix}
+        errors = {op: 0 for op in mix}
+        started = time.perf_counter()
+        measure_from = started + warmup
+        stop_at = measure_from + duration
+
+        async def user(index: int):
+            session = VirtualUser(random.Random(seed_value + index), catalog, mix)
+            while True:
+                op, path, params = session.next_request()
+                sent = time.perf_counter()
+                if sent >= stop_at:
+                    return
+                try:
+                    response = await client.get(path, params=params)
+                    failed = response.status_code >= 400
+                except httpx.HTTPError:
+                    response, failed = None, True
+                finished = time.perf_counter()
+                if sent >= measure_from:
+                    if failed:
+                        errors[op] += 1
+                    else:
+                        samples[op].append(finished - sent)
+                if response is not None and not failed:
+                    session.observe(path, params, response)
+
+        await asyncio.gather(*(user(i) for i in range(concurrency)))
+        elapsed = time.perf_counter() - measure_from
+
+    return {
+        'meta': {
+            'started_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'commit': git_commit(),
+            'url': url,
+            'mix': mix_name,
+            'duration_s': duration,
+            'warmup_s': warmup,
+            'concurrency': concurrency,
+            'seed': seed_value,
+            'catalog': {'categories': len(catalog.categories), 'brands': len(catalog.brands),
+                        'products_estimate': catalog.total},
+        },
+        'overall': summarize([s for op in samples.values() for s in op], sum(errors.values()), elapsed),
+        'operations': {op: summarize(samples[op], errors[op], elapsed) for op in mix},
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def spawn_server(database: str, server_args: str):
+    port = free_port()
+    env = dict(os.environ, DB_DATABASE=database)
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'uvicorn', 'api:app', '--host', '127.0.0.1', '--port', str(port),
+         '--no-access-log', *server_args.split()],
+        cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    url = f'http://127.0.0.1:{port}'
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise SystemExit(f"server exited with code {process.returncode}")
+        try:
+            if httpx.get(f'{url}/api/health', timeout=1).json().get('status') == 'healthy':
+                return process, url
+        except (httpx.HTTPError, ValueError):
+            pass
+        time.sleep(0.5)
+    process.terminate()
+    raise SystemExit("server did not become healthy within 60s")
+
+
+def print_result(result: dict):
+    meta = result['meta']
+    print(f"\nmix={meta['mix']} concurrency={meta['concurrency']} duration={meta['duration_s']}s commit={meta['commit']}")
+    print(f"{'operation':<22}{'requests':>9}{'errors':>8}{'rps':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+    for name, stats in [*result['operations'].items(), ('overall', result['overall'])]:
+        if not stats['requests']:
+            print(f"{name:<22}{0:>9}{stats['errors']:>8}")
+            continue
+        print(f"{name:<22}{stats['requests']:>9}{stats['errors']:>8}{stats['rps']:>9}"
+              f"{stats['p50_ms']:>9}{stats['p95_ms']:>9}{stats['p99_ms']:>9}")
+
+
+def run(args):
+    process = None
+    url = args.url
+    if args.spawn:
+        bench_db.bench_config(args.database)
+        process, url = spawn_server(args.database, args.server_args)
+    try:
+        result = asyncio.run(drive(url, args.mix, args.duration, args.warmup, args.concurrency, args.seed))
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait(timeout=30)
+
+    print_result(result)
+    output = args.output or os.path.join(
+        bench_db.RESULTS_DIR, f"catalog-{args.mix}-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(result, f, indent=2, ensure_ascii=False)
+    print(f"saved {output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if compare_results(baseline, result, args.threshold):
+            sys.exit(1)
+
+
+# --- comparison ---
+
+def change(before, after) -> float:
+    return (after - before) / before * 100 if before else 0.0
+
+
+def compare_results(before: dict, after: dict, threshold: float, min_delta_ms: float = 1.0) -> list:
+    """
+    Print per-operation deltas; an operation regresses when its rps drops, or
+    its p95/p99 grows, by more than threshold percent (latency also by more
+    than min_delta_ms, so sub-millisecond jitter is not flagged). Returns the
+    regressions.
+    """
+    if before['meta']['mix'] != after['meta']['mix']:
+        print(f"warning: comparing different mixes ({before['meta']['mix']} vs {after['meta']['mix']})")
+    regressions = []
+    print(f"\n{'operation':<22}{'rps':>16}{'p50 ms':>18}{'p95 ms':>18}{'p99 ms':>18}")
+    pairs = [(op, before['operations'].get(op), stats) for op, stats in after['operations'].items()]
+    for name, old, new in [*pairs, ('overall', before['overall'], after['overall'])]:
+        if not old or not old.get('requests') or not new.get('requests'):
+            continue
+        flags = []
+        if change(old['rps'], new['rps']) < -threshold:
+            flags.append('rps')
+        for key in ('p95_ms', 'p99_ms'):
+            if change(old[key], new[key]) > threshold and new[key] - old[key] > min_delta_ms:
+                flags.append(key[:3])
+        if new['errors'] > old['errors']:
+            flags.append('errors')
+        cells = ''.join(f"{new[k]} ({change(old[k], new[k]):+.1f}%)".rjust(18)
+                        for k in ('rps', 'p50_ms', 'p95_ms', 'p99_ms'))
+        print(f"{name:<22}{cells}{'  REGRESSION: ' + ', '.join(flags) if flags else ''}")
+        if flags:
+            regressions.append((name, flags))
+    print(f"\n{len(regressions)} regression(s) at threshold {threshold}%")
+    return regressions
+
+
+def compare(args):
+    with open(args.before) as f:
+        before = json.load(f)
+    with open(args.after) as f:
+        after = json.load(f)
+    if compare_results(before, after, args.threshold):
+        sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0],
+                                     formatter_class=argparse.RawDescriptionHelpFormatter, epilog=__doc__)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    seed_parser = commands.add_parser('seed', help='fill the bench database with a synthetic catalog')
+    seed_parser.add_argument('--database', default=bench_db.BENCH_DATABASE)
+    seed_parser.add_argument('--products', type=int, default=100000)
+    seed_parser.add_argument('--categories', type=int, default=120)
+    seed_parser.add_argument('--brands', type=int, default=60)
+    seed_parser.add_argument('--batch', type=int, default=20000, help='products per COPY')
+    seed_parser.add_argument('--seed', type=int, default=1)
+    seed_parser.set_defaults(func=seed)
+
+    run_parser = commands.add_parser('run', help='drive a browsing mix and save the results')
+    run_parser.add_argument('--url', default='http://127.0.0.1:8000')
+    run_parser.add_argument('--spawn', action='store_true', help='start a server against the bench database')
+    run_parser.add_argument('--server-args', default='', help='extra uvicorn arguments for --spawn')
+    run_parser.add_argument('--database', default=bench_db.BENCH_DATABASE)
+    run_parser.add_argument('--mix', choices=sorted(MIXES), default='browse')
+    run_parser.add_argument('--duration', type=float, default=30, help='measured seconds')
+    run_parser.add_argument('--warmup', type=float, default=5, help='seconds before measuring')
+    run_parser.add_argument('--concurrency', type=int, default=16, help='virtual users')
+    run_parser.add_argument('--seed', type=int, default=1)
+    run_parser.add_argument('--output', help='result file (default benchmarks/results/catalog-<mix>-<time>.json)')
+    run_parser.add_argument('--baseline', help='result file to compare against; exit 1 on regression')
+    run_parser.add_argument('--threshold', type=float, default=10, help='regression threshold, percent')
+    run_parser.set_defaults(func=run)
+
+    compare_parser = commands.add_parser('compare', help='compare two result files')
+    compare_parser.add_argument('before')
+    compare_parser.add_argument('after')
+    compare_parser.add_argument('--threshold', type=float, default=10, help='regression threshold, percent')
+    compare_parser.set_defaults(func=compare)
+
+    args = parser.parse_args()
+    # api's logging setup would otherwise log every client request
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
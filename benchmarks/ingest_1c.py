@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+"""
+End-to-end 1C price-list ingestion benchmark against the bench database.
+
+Runs three phases on one catalog, each in a fresh process so peak RSS is
+per phase:
+
+  initial  version 0 into an empty catalog (all creates)
+  resync   the same payload again (all unchanged)
+  delta    version 1: --changed products with new price/stock, --new new ones
+
+and drives process_price_list (--path price_list, JSON body) or
+process_1c_data (--path 1c, any --format) exactly as the webhooks do,
+parse pool and shards included. Reports rows/s, peak RSS of the process
+and of its parse/shard workers, and DB round trips (statements + commits)
+per product.
+
+Usage: python benchmarks/ingest_1c.py --items 100000 --path 1c --format xml --shards 0
+"""
+
+import os
+import gc
+import sys
+import json
+import time
+import asyncio
+import argparse
+import resource
+import subprocess
+from datetime import datetime
+
+import bench_db
+import payloads_1c
+import api  # noqa: E402 (on sys.path via bench_db)
+
+PHASES = {
+    'initial': 0,
+    'resync': 0,
+    'delta': 1,
+}
+
+
+def peak_rss_mb(who=resource.RUSAGE_SELF) -> float:
+    # ru_maxrss is in kilobytes on Linux
+    return round(resource.getrusage(who).ru_maxrss / 1024, 1)
+
+
+class RoundTrips:
+    """Counts statements through api's traced cursors and commits on its connections"""
+
+    def __init__(self):
+        self.stats = {"db_queries": 0, "db_ms": 0.0}
+        self.commits = 0
+
+    def install(self):
+        api.request_stats_var.set(self.stats)
+        counter = self
+        traced_commit = api.TracedConnection.commit
+
+        def commit(conn):
+            counter.commits += 1
+            return traced_commit(conn)
+
+        api.TracedConnection.commit = commit
+
+
+def run_phase(args, version: int) -> dict:
+    config = bench_db.bench_config(args.database)
+    bench_db.use_bench_database(config)
+
+    products = payloads_1c.generate_items(args.items, version, args.changed, args.new, args.invalid, args.seed)
+    if args.path == 'price_list':
+        payload = json.dumps(payloads_1c.build_payload('json', products), ensure_ascii=False).encode()
+    else:
+        payload = payloads_1c.build_payload(args.format, products)
+    gc.collect()
+    rss_payload = peak_rss_mb()
+
+    round_trips = RoundTrips()
+    round_trips.install()
+
+    async def ingest():
+        if args.path == 'price_list':
+            return await api.process_price_list(payload)
+        return await api.process_1c_data(payload, shards=args.shards)
+
+    started = time.perf_counter()
+    result = asyncio.run(ingest())
+    elapsed = time.perf_counter() - started
+
+    api.close_parse_executor()
+    api.close_ingest_executor()
+    api.close_db_pool()
+
+    statements = round_trips.stats["db_queries"]
+    return {
+        'version': version,
+        'items': args.items,
+        'seconds': round(elapsed, 2),
+        'rows_per_s': round(args.items / elapsed),
+        'result': result,
+        'statements': statements,
+        'commits': round_trips.commits,
+        'round_trips_per_product': round((statements + round_trips.commits) / args.items, 4),
+        'db_ms': round(round_trips.stats["db_ms"]),
+        # Shard workers run their own statements in other processes
+        'round_trips_scope': 'parent process only' if args.shards > 1 and args.path == '1c' else 'all',
+        'rss_with_payload_mb': rss_payload,
+        'peak_rss_mb': peak_rss_mb(),
+        'workers_peak_rss_mb': peak_rss_mb(resource.RUSAGE_CHILDREN),
+    }
+
+
+def child_args(args, phase: str) -> list:
+    return [sys.executable, __file__, '--child', phase,
+            '--items', str(args.items), '--path', args.path, '--format', args.format,
+            '--shards', str(args.shards), '--changed', str(args.changed), '--new', str(args.new),
+            '--invalid', str(args.invalid), '--seed', str(args.seed), '--database', args.database]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--items', type=int, default=100000, help='products per payload (1k..1M)')
+    parser.add_argument('--path', choices=('price_list', '1c'), default='1c',
+                        help='process_price_list (JSON webhook) or process_1c_data')
+    parser.add_argument('--format', choices=('json', 'xml', 'csv', 'nested'), default='json',
+                        help='payload format for --path 1c')
+    parser.add_argument('--shards', type=int, default=api.INGEST_SHARDS, help='shards for --path 1c')
+    parser.add_argument('--changed', type=float, default=0.1, help='delta phase: share of changed products')
+    parser.add_argument('--new', type=float, default=0.02, help='delta phase: share of new products')
+    parser.add_argument('--invalid', type=float, default=0.0, help='share of unparseable products')
+    parser.add_argument('--phases', default='initial,resync,delta')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--database', default=bench_db.BENCH_DATABASE)
+    parser.add_argument('--output', help='result file (default benchmarks/results/ingest-<path>-<format>-<items>-<time>.json)')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run_phase(args, PHASES[args.child])))
+        return
+
+    phases = args.phases.split(',')
+    bench_db.prepare_schema(bench_db.bench_config(args.database), reset=True)
+    api.close_db_pool()
+
+    results = {}
+    for phase in phases:
+        out = subprocess.run(child_args(args, phase), check=True, capture_output=True, text=True).stdout
+        results[phase] = json.loads(out.strip().splitlines()[-1])
+        r = results[phase]
+        print(f"{phase:<8} {r['items']:>8} items {r['seconds']:>8}s {r['rows_per_s']:>8} rows/s  "
+              f"created {r['result']['created']} updated {r['result']['updated']} "
+              f"unchanged {r['result']['unchanged']} errors {r['result']['errors']}  "
+              f"round trips/product {r['round_trips_per_product']} ({r['round_trips_scope']})  "
+              f"peak RSS {r['peak_rss_mb']} MB, workers {r['workers_peak_rss_mb']} MB")
+
+    fmt = 'json' if args.path == 'price_list' else args.format
+    output = args.output or os.path.join(
+        bench_db.RESULTS_DIR, f"ingest-{args.path}-{fmt}-{args.items}-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump({'settings': {k: v for k, v in vars(args).items() if k not in ('child', 'output')},
+                   'phases': results}, f, indent=2, ensure_ascii=False)
+    print(f"saved {output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""
+Per-request cost of the Prometheus instrumentation.
+
+Drives the real ASGI app in-process (no sockets, no database) with
+--concurrency requests in flight, once with METRICS_ENABLED=false and once
+with it on, each in a fresh interpreter, and reports the difference.
+/api/categories is served from a pre-filled catalog cache, so the numbers
+are the framework + middleware + handler path the instrumentation sits on.
+
+Usage: python benchmarks/metrics_overhead.py --requests 20000 --concurrency 32
+"""
+
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import subprocess
+import statistics
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+PATHS = ("/", "/api/categories", "/api/no-such-route")
+
+
+def make_scope(path: str) -> dict:
+    return {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1",
+        "method": "GET", "scheme": "http", "path": path, "raw_path": path.encode(),
+        "root_path": "", "query_string": b"", "headers": [(b"host", b"bench")],
+        "client": ("127.0.0.1", 1), "server": ("bench", 80),
+    }
+
+
+async def request(app, path: str) -> float:
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        pass
+
+    started = time.perf_counter()
+    await app(make_scope(path), receive, send)
+    return time.perf_counter() - started
+
+
+async def drive(total: int, concurrency: int) -> dict:
+    import api
+
+    api.catalog_cache.set(("categories",), (b"[]", api.body_etag(b"[]")), api.catalog_cache.generation)
+    app = api.app
+    latencies = []
+
+    async def client(n: int):
+        for i in range(n):
+            latencies.append(await request(app, PATHS[i % len(PATHS)]))
+
+    # Warm-up builds the middleware stack and the label children
+    await asyncio.gather(*(client(50) for _ in range(concurrency)))
+    latencies.clear()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client(total // concurrency) for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "metrics": api.METRICS_ENABLED,
+        "requests": len(latencies),
+        "rps": round(len(latencies) / elapsed),
+        "us_per_request": round(elapsed / len(latencies) * 1e6, 1),
+        "p50_us": round(latencies[len(latencies) // 2] * 1e6, 1),
+        "p99_us": round(latencies[int(len(latencies) * 0.99)] * 1e6, 1),
+    }
+
+
+def run_child(enabled: bool, total: int, concurrency: int) -> dict:
+    env = dict(os.environ, METRICS_ENABLED="true" if enabled else "false", PYTHONPATH=ROOT)
+    env.pop("PROMETHEUS_MULTIPROC_DIR", None)
+    out = subprocess.run(
+        [sys.executable, __file__, "--child", "--requests", str(total), "--concurrency", str(concurrency)],
+        env=env, check=True, capture_output=True, text=True
+    ).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--requests", type=int, default=20000)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--rounds", type=int, default=3, help="alternating off/on runs; medians are reported")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(asyncio.run(drive(args.requests, args.concurrency))))
+        return
+
+    runs = {False: [], True: []}
+    for _ in range(args.rounds):
+        for enabled in (False, True):
+            result = run_child(enabled, args.requests, args.concurrency)
+            runs[enabled].append(result)
+            print(result)
+
+    off = statistics.median(r["us_per_request"] for r in runs[False])
+    on = statistics.median(r["us_per_request"] for r in runs[True])
+    print(f"median per request: off {off:.1f} us, on {on:.1f} us, "
+          f"overhead {on - off:.1f} us ({(on - off) / off * 100:.1f}%)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+"""
+1C payload normalizer benchmark: nested JSON, CSV raw_data and XML.
+
+The "before" column is the previous implementation (recursive
+find_products_in_data that descends into products/товары keys twice, and
+per-field alias probing for CSV/XML), copied here as the baseline.
+
+Usage: python benchmarks/normalizer.py --depth 8 --fanout 2 --items 10
+"""
+
+import os
+import sys
+import csv
+import json
+import time
+import argparse
+import xml.etree.ElementTree as ET
+from io import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import api  # noqa: E402
+
+
+# --- previous implementation (baseline) ---
+
+def old_find_products_in_data(data):
+    products = []
+
+    def find_products_recursive(obj, path=""):
+        if isinstance(obj, list):
+            for item in obj:
+                if isinstance(item, dict) and any(key in item for key in ['name', 'Наименование', 'price', 'Цена']):
+                    products.append(item)
+                find_products_recursive(item, f"{path}[]")
+        elif isinstance(obj, dict):
+            for key, value in obj.items():
+                if key.lower() in ['products', 'товары', 'items', 'элементы']:
+                    find_products_recursive(value, f"{path}.{key}")
+                find_products_recursive(value, f"{path}.{key}")
+
+    find_products_recursive(data)
+    return products
+
+
+def old_get_xml_text(element, tag_names):
+    for tag in tag_names:
+        child = element.find(tag)
+        if child is not None and child.text:
+            return child.text.strip()
+    return ''
+
+
+def old_parse_1c_xml(xml_data):
+    root = ET.fromstring(xml_data)
+    products = []
+    for item in root.findall('.//Товар') or root.findall('.//Product') or root.findall('.//item'):
+        products.append({
+            'name': old_get_xml_text(item, ['Наименование', 'Name', 'name']),
+            'description': old_get_xml_text(item, ['Описание', 'Description', 'description']),
+            'price': float(old_get_xml_text(item, ['Цена', 'Price', 'price']) or '0'),
+            'category': old_get_xml_text(item, ['Категория', 'Category', 'category']),
+            'brand': old_get_xml_text(item, ['Бренд', 'Brand', 'brand']),
+            'sku': old_get_xml_text(item, ['Артикул', 'Article', 'sku']),
+            'stock_quantity': int(old_get_xml_text(item, ['Остаток', 'Stock', 'stock_quantity']) or '0')
+        })
+    return products
+
+
+def old_parse_csv(raw_data):
+    products = []
+    for row in csv.DictReader(StringIO(raw_data)):
+        products.append({
+            'name': row.get('Наименование', row.get('name', '')),
+            'description': row.get('Описание', row.get('description', '')),
+            'price': float(row.get('Цена', row.get('price', 0))),
+            'category': row.get('Категория', row.get('category', '')),
+            'brand': row.get('Бренд', row.get('brand', '')),
+            'sku': row.get('Артикул', row.get('sku', '')),
+            'stock_quantity': int(row.get('Остаток', row.get('stock_quantity', 0)))
+        })
+    return products
+
+
+# --- payloads ---
+
+def product(i):
+    return {
+        'Артикул': f'SKU-{i}',
+        'Наименование': f'Товар {i}',
+        'Описание': f'Описание {i}',
+        'Цена': str(100 + i % 900),
+        'Категория': f'Категория {i % 50}',
+        'Бренд': f'Бренд {i % 20}',
+        'Остаток': str(i % 100),
+    }
+
+
+def nested_payload(depth, fanout, items):
+    """Каталог-дерево: на каждом уровне товары и fanout подкаталогов под ключом 'товары'"""
+    counter = [0]
+
+    def level(d):
+        nodes = []
+        for _ in range(items):
+            nodes.append(product(counter[0]))
+            counter[0] += 1
+        if d < depth:
+            nodes.extend({'Группа': f'g{d}', 'товары': level(d + 1)} for _ in range(fanout))
+        return nodes
+
+    return {'Каталог': {'товары': level(1)}}, counter[0]
+
+
+def csv_payload(items):
+    out = StringIO()
+    writer = csv.writer(out)
+    writer.writerow(product(0).keys())
+    for i in range(items):
+        writer.writerow(product(i).values())
+    return out.getvalue()
+
+
+def xml_payload(items):
+    parts = ['<Каталог><Товары>']
+    for i in range(items):
+        parts.append('<Товар>' + ''.join(f'<{k}>{v}</{k}>' for k, v in product(i).items()) + '</Товар>')
+    parts.append('</Товары></Каталог>')
+    return ''.join(parts)
+
+
+def timed(func, *args):
+    started = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - started, len(result)
+
+
+def report(name, old, new, expected):
+    (old_s, old_n), (new_s, new_n) = old, new
+    print(f"{name:<28} before {old_s * 1000:9.1f} ms ({old_n:>8} items)   "
+          f"after {new_s * 1000:8.1f} ms ({new_n:>7} items, expected {expected})   x{old_s / new_s:.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--depth', type=int, default=8, help='nesting depth of the catalog tree')
+    parser.add_argument('--fanout', type=int, default=2, help='sub-catalogs per level')
+    parser.add_argument('--items', type=int, default=10, help='products per catalog node')
+    parser.add_argument('--flat', type=int, default=100000, help='products in CSV / XML payloads')
+    args = parser.parse_args()
+
+    for depth in range(2, args.depth + 1, 2):
+        data, expected = nested_payload(depth, args.fanout, args.items)
+        report(f"nested depth={depth}", timed(old_find_products_in_data, data),
+               timed(api.extract_1c_products, data), expected)
+
+    raw = csv_payload(args.flat)
+    report("csv raw_data", timed(old_parse_csv, raw), timed(api.parse_1c_raw_data, raw), args.flat)
+
+    xml = xml_payload(args.flat)
+    report("xml_data", timed(old_parse_1c_xml, xml), timed(api.parse_1c_xml, xml), args.flat)
+
+    # Deep chain: the recursive walker hits the recursion limit, the iterative one does not
+    chain = {'товары': [product(0)]}
+    for _ in range(5000):
+        chain = {'товары': [chain]}
+    try:
+        old_find_products_in_data(chain)
+        old = 'ok'
+    except RecursionError:
+        old = 'RecursionError'
+    print(f"{'chain depth=5000':<28} before {old}   after {len(api.extract_1c_products(chain))} item(s)")
+
+
+if __name__ == '__main__':
+    main()
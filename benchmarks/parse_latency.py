@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+Event-loop latency while a large 1C payload is being parsed.
+
+Runs a 5 ms ticker on the event loop and measures how late each tick fires
+while prepare_1c_products() parses an XML price list, first inline on the
+loop (the old behaviour) and then through run_parser() (process pool).
+
+Usage: python benchmarks/parse_latency.py --items 200000
+"""
+
+import os
+import sys
+import time
+import asyncio
+import argparse
+import statistics
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import api  # noqa: E402
+
+TICK = 0.005
+
+
+def build_xml(items: int) -> str:
+    parts = ['<КоммерческаяИнформация><Каталог><Товары>']
+    for i in range(items):
+        parts.append(
+            f'<Товар><Артикул>SKU-{i}</Артикул><Наименование>Товар {i}</Наименование>'
+            f'<Описание>Описание товара {i}</Описание><Цена>{100 + i % 900}.50</Цена>'
+            f'<Категория>Категория {i % 50}</Категория><Бренд>Бренд {i % 20}</Бренд>'
+            f'<Остаток>{i % 100}</Остаток></Товар>'
+        )
+    parts.append('</Товары></Каталог></КоммерческаяИнформация>')
+    return ''.join(parts)
+
+
+async def measure(work) -> dict:
+    lags = []
+    done = False
+
+    async def ticker():
+        while not done:
+            started = time.perf_counter()
+            await asyncio.sleep(TICK)
+            lags.append((time.perf_counter() - started - TICK) * 1000)
+
+    task = asyncio.ensure_future(ticker())
+    await asyncio.sleep(TICK * 4)
+    started = time.perf_counter()
+    rows, errors = await work()
+    elapsed = time.perf_counter() - started
+    done = True
+    await task
+
+    lags.sort()
+    return {
+        "rows": len(rows),
+        "errors": errors,
+        "parse_s": round(elapsed, 2),
+        "ticks": len(lags),
+        "lag_p50_ms": round(statistics.median(lags), 2),
+        "lag_p99_ms": round(lags[int(len(lags) * 0.99) - 1], 2),
+        "lag_max_ms": round(lags[-1], 2),
+    }
+
+
+async def main(items: int):
+    data = {"xml_data": build_xml(items)}
+
+    async def inline():
+        return api.prepare_1c_products(data)
+
+    async def pooled():
+        return await api.run_parser(api.prepare_1c_products, data)
+
+    # First call spawns the pool processes; keep it out of the measurement
+    await api.run_parser(api.prepare_1c_products, {"products": []})
+
+    print("inline on event loop:", await measure(inline))
+    print("process pool:        ", await measure(pooled))
+    api.close_parse_executor()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--items", type=int, default=200000, help="products in the generated payload")
+    args = parser.parse_args()
+    asyncio.run(main(args.items))
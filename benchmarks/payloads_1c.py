@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""
+Synthetic 1C price lists in every format api.py accepts.
+
+  json     {"products": [{"Артикул": ..., "Наименование": ..., ...}]}
+  xml      {"xml_data": "<КоммерческаяИнформация>...<Товар>...</Товар>..."}
+  csv      {"raw_data": "Артикул,Наименование,..."} (Russian headers)
+  nested   catalog tree of groups, products under "товары" at every level
+  ndjson   one product per line, for POST /webhook/price-list/stream
+
+A payload is version `version` of a catalog of `items` products: version 0
+is the baseline, later versions change the price/stock of a `changed`
+fraction of the products, replace a `new` fraction with products that did
+not exist before and make an `invalid` fraction unparseable. The same
+arguments always produce the same payload.
+
+Usage: python benchmarks/payloads_1c.py --items 100000 --format xml --version 1 --changed 0.1 -o payload.json
+"""
+
+import io
+import csv
+import json
+import random
+import argparse
+from xml.sax.saxutils import escape
+
+FORMATS = ('json', 'xml', 'csv', 'nested', 'ndjson')
+
+FIELDS = ('Артикул', 'Наименование', 'Описание', 'Цена', 'Категория', 'Бренд', 'Остаток')
+
+KINDS = ['Диван', 'Кресло', 'Стол', 'Стул', 'Шкаф', 'Комод', 'Кровать', 'Полка', 'Светильник', 'Ковёр',
+         'Зеркало', 'Тумба', 'Люстра', 'Плед', 'Подушка', 'Ваза', 'Гардероб', 'Стеллаж', 'Пуф', 'Банкетка']
+MODELS = ['Осло', 'Берген', 'Норд', 'Лофт', 'Милан', 'Верона', 'Классик', 'Прованс', 'Сканди', 'Рига']
+MATERIALS = ['дуб', 'бук', 'сосна', 'ясень', 'металл', 'стекло', 'велюр', 'лён', 'кожа', 'ротанг']
+CATEGORIES = ['Мягкая мебель', 'Столы и стулья', 'Хранение', 'Спальня', 'Освещение', 'Текстиль',
+              'Декор', 'Детская', 'Прихожая', 'Кухня', 'Сад и терраса', 'Офис']
+BRANDS = ['Норд Хоум', 'Каза', 'Вудлайн', 'Лофт Арт', 'Хюгге', 'Мосс', 'Форма', 'Линия', 'Дом Мебели',
+          'Уют', 'Сканди Форм', 'Арт Вуд']
+
+
+def format_price(value: float, rng: random.Random) -> str:
+    """1C sends prices as "1299.50", "1299,50" or "1 299,50" depending on export settings"""
+    style = rng.random()
+    if style < 0.5:
+        return f"{value:.2f}"
+    text = f"{value:,.2f}".replace(',', ' ').replace('.', ',')
+    return text if style < 0.8 else text.replace(' ', '')
+
+
+def product(index: int, version: int = 0) -> dict:
+    """Product `index` as of catalog version `version` (price and stock move with the version)"""
+    rng = random.Random(index)
+    kind, model, material = rng.choice(KINDS), rng.choice(MODELS), rng.choice(MATERIALS)
+    price = rng.randint(5, 2000) * 50 - 10 + version * 10
+    stock = (rng.randint(0, 300) + version * 7) % 301
+    return {
+        'Артикул': f"1C-{index:08d}",
+        'Наименование': f"{kind} {model} {material} {index}",
+        'Описание': f"{kind} «{model}», материал: {material}. Артикул производителя {rng.randint(10000, 99999)}.",
+        'Цена': format_price(price, rng),
+        'Категория': CATEGORIES[index % len(CATEGORIES)],
+        'Бренд': BRANDS[(index // 7) % len(BRANDS)],
+        'Остаток': str(stock),
+    }
+
+
+def generate_items(items: int, version: int = 0, changed: float = 0.0, new: float = 0.0,
+                   invalid: float = 0.0, seed: int = 1):
+    """
+    Yield the products of one payload. Products 0..items-1 form the catalog;
+    `new` of them are swapped for products first seen in this version,
+    `changed` carry this version's price/stock, `invalid` have an unparseable price.
+    """
+    rng = random.Random(seed * 1000003 + version)
+    for index in range(items):
+        roll = rng.random()
+        if version and roll < new:
+            item = product(10_000_000 * version + index)
+        elif version and roll < new + changed:
+            item = product(index, version)
+        else:
+            item = product(index)
+        if rng.random() < invalid:
+            item['Цена'] = 'по запросу'
+        yield item
+
+
+def nested_tree(products: list, fanout: int = 4, leaf_size: int = 500) -> dict:
+    """Catalog groups nested until a group holds at most leaf_size products"""
+    def group(chunk, depth):
+        node = {'Наименование группы': f"Группа {depth}", 'Ид': f"g-{depth}-{len(chunk)}"}
+        if len(chunk) <= leaf_size:
+            node['товары'] = chunk
+            return node
+        # A few products on the group itself, the rest split between subgroups
+        own, rest = chunk[:leaf_size // 10], chunk[leaf_size // 10:]
+        step = -(-len(rest) // fanout)
+        node['товары'] = own
+        node['Группы'] = [group(rest[i:i + step], depth + 1) for i in range(0, len(rest), step)]
+        return node
+
+    return {'КоммерческаяИнформация': {'Версия': '2.10', 'Каталог': {'Группы': [group(products, 1)]}}}
+
+
+def xml_document(products) -> str:
+    parts = ['<?xml version="1.0" encoding="UTF-8"?><КоммерческаяИнформация ВерсияСхемы="2.10"><Каталог><Товары>']
+    for item in products:
+        parts.append('<Товар>' + ''.join(f'<{key}>{escape(value)}</{key}>' for key, value in item.items()) + '</Товар>')
+    parts.append('</Товары></Каталог></КоммерческаяИнформация>')
+    return ''.join(parts)
+
+
+def csv_document(products) -> str:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(FIELDS)
+    for item in products:
+        writer.writerow(item[field] for field in FIELDS)
+    return buffer.getvalue()
+
+
+def build_payload(fmt: str, products):
+    """1C webhook payload (a dict) for json/xml/csv/nested; NDJSON text for ndjson"""
+    if fmt == 'json':
+        return {'products': list(products)}
+    if fmt == 'xml':
+        return {'xml_data': xml_document(products)}
+    if fmt == 'csv':
+        return {'raw_data': csv_document(products)}
+    if fmt == 'nested':
+        return nested_tree(list(products))
+    if fmt == 'ndjson':
+        return ''.join(json.dumps(item, ensure_ascii=False) + '\n' for item in products)
+    raise ValueError(f"unknown format {fmt!r}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--items', type=int, default=1000, help='products in the payload (1k..1M)')
+    parser.add_argument('--format', choices=FORMATS, default='json')
+    parser.add_argument('--version', type=int, default=0, help='0 = baseline catalog')
+    parser.add_argument('--changed', type=float, default=0.1, help='share of products with new price/stock')
+    parser.add_argument('--new', type=float, default=0.02, help='share of products not in the baseline')
+    parser.add_argument('--invalid', type=float, default=0.0, help='share of products with an unparseable price')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('-o', '--output', default='-', help='file to write (default stdout)')
+    args = parser.parse_args()
+
+    payload = build_payload(args.format, generate_items(args.items, args.version, args.changed, args.new,
+                                                        args.invalid, args.seed))
+    text = payload if isinstance(payload, str) else json.dumps(payload, ensure_ascii=False)
+    if args.output == '-':
+        print(text, end='')
+    else:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+Serial share of a sharded 1C import, and the speed-up it allows.
+
+sync_products_sharded() leaves no per-row work in the API process: it resolves
+the payload's categories and brands once, hands each shard process the byte
+ranges of its chunks and adds up the counters. Every row is touched by two
+processes only:
+
+  parse worker   decoding the payload, mapping fields, hashing rows to shards and
+                 spilling each shard's chunks to its file (partition_products) - serial
+  shard worker   reading a chunk back and normalizing it (sync_shard_chunk) before
+                 the write - parallel, one process per shard
+
+(The parent's share, pickling one (path, offset, length) range and the two
+dictionaries per chunk, is printed per row for completeness.) No database is
+needed: the script times these steps on a synthetic price list and prints
+microseconds per row. Pass the per-row write cost of the serial path, measured
+with `ingest_1c.py --shards 0` as 1e6 / rows_per_s, and the script prints the
+Amdahl bound for each shard count against the serial path (which decodes and
+normalizes in the parse worker, then writes):
+
+  speed-up(N) <= (decode + normalize + write) / (partition + (read + write) / N)
+
+Usage: python benchmarks/shard_parent.py --items 200000 --write-us-per-row 40 --shards 2,4,8,16
+"""
+
+import os
+import sys
+import json
+import time
+import pickle
+import shutil
+import argparse
+
+import payloads_1c
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import api  # noqa: E402
+
+
+def timed(func, *args):
+    started = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - started
+
+
+def read_chunks(lanes):
+    for chunks in lanes:
+        for path, offset, length, _ in chunks:
+            with open(path, 'rb') as file:
+                file.seek(offset)
+                api.normalize_products(pickle.loads(file.read(length)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--items', type=int, default=200000)
+    parser.add_argument('--chunk-size', type=int, default=api.INGEST_CHUNK_SIZE)
+    parser.add_argument('--shards', default='2,4,8,16', help='shard counts to report the bound for')
+    parser.add_argument('--write-us-per-row', type=float, help='serial write cost per row, from ingest_1c.py --shards 0')
+    args = parser.parse_args()
+    shard_counts = [int(value) for value in args.shards.split(',')]
+    api.INGEST_SHARD_MIN_ROWS = 0
+
+    body = json.dumps({'products': list(payloads_1c.generate_items(args.items))}, ensure_ascii=False).encode()
+    (rows, errors), serial_parse = timed(api.prepare_price_list, body)
+    (_, _, spill), partition = timed(api.partition_price_list, body, max(shard_counts), args.chunk_size)
+    try:
+        _, read = timed(read_chunks, spill['lanes'])
+        category_ids = {name: i for i, name in enumerate(spill['categories'], 1)}
+        brand_ids = {name: i for i, name in enumerate(spill['brands'], 1)}
+        _, dispatch = timed(lambda: [pickle.dumps((path, offset, length, category_ids, brand_ids))
+                                     for chunks in spill['lanes'] for path, offset, length, _ in chunks])
+    finally:
+        shutil.rmtree(spill['directory'], ignore_errors=True)
+
+    per_row = {name: seconds * 1e6 / spill['total'] for name, seconds in
+               (('serial parse', serial_parse), ('partition', partition), ('read', read), ('dispatch', dispatch))}
+    print(f"{spill['total']} rows ({errors} invalid), chunk size {args.chunk_size}")
+    for name, value in per_row.items():
+        print(f"  {name:<13} {value:6.2f} us/row")
+    print(f"  partitioning alone caps a payload at {1e6 / per_row['partition']:,.0f} rows/s whatever the shard count")
+
+    if args.write_us_per_row:
+        write = args.write_us_per_row
+        for shards in shard_counts:
+            serial = per_row['serial parse'] + write
+            bound = serial / (per_row['partition'] + per_row['dispatch'] + (per_row['read'] + write) / shards)
+            print(f"  {shards:>3} shards: speed-up <= {bound:4.1f}x ({bound / shards:.0%} of linear)")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,21 @@
 #!/bin/bash
 # Скрипт запуска API для каталога товаров
+#
+#   ./start_api.sh             разработка: один процесс, --reload
+#   ./start_api.sh production  продакшен: воркеры по числу CPU, прогрев, плавная остановка
+#
+# Режим можно задать и переменной API_MODE. В продакшене:
+#   kill -HUP <pid>   перезапуск воркеров по одному (новый воркер принимает запросы
+#                     только после прогрева, слушающий сокет не закрывается) - для деплоя
+#   kill -TERM <pid>  остановка: воркеры дорабатывают начатые запросы (GRACEFUL_TIMEOUT)
+#
+# Схема БД в продакшене применяется один раз при деплое, до запуска воркеров:
+#   python3 api.py migrate    (код выхода 1, если часть схемы применить не удалось)
+# В режиме разработки её применяет сам API при запуске (DB_AUTO_MIGRATE=true)
+
+MODE="${1:-${API_MODE:-dev}}"
+API_HOST="${API_HOST:-0.0.0.0}"
+API_PORT="${API_PORT:-8000}"
 
 echo "Запуск API для cozyrenovations.ru..."
 
@@ -36,6 +52,53 @@ except Exception as e:
     exit(1)
 "
 
+# Число доступных CPU: nproc учитывает привязку к ядрам, квоту cgroup (контейнеры) - нет
+cpu_count() {
+    local cpus quota period
+    cpus=$(nproc)
+    if [ -r /sys/fs/cgroup/cpu.max ]; then
+        read -r quota period < /sys/fs/cgroup/cpu.max
+        if [ "$quota" != "max" ]; then
+            quota=$(( (quota + period - 1) / period ))
+            [ "$quota" -lt "$cpus" ] && cpus=$quota
+        fi
+    fi
+    echo "$cpus"
+}
+
+if [ "$MODE" = "production" ]; then
+    API_WORKERS="${API_WORKERS:-$(cpu_count)}"
+
+    # Метрики всех воркеров в одном /metrics; каталог очищается при каждом запуске
+    export PROMETHEUS_MULTIPROC_DIR="${PROMETHEUS_MULTIPROC_DIR:-/tmp/cozyrenovations-api-metrics}"
+    rm -rf "$PROMETHEUS_MULTIPROC_DIR"
+    mkdir -p "$PROMETHEUS_MULTIPROC_DIR"
+
+    # Слушающий сокет открывает родительский процесс, воркеры его наследуют.
+    # При запуске через systemd socket activation сокет принадлежит systemd (fd 3)
+    # и переживает перезапуск сервиса целиком.
+    if [ -n "$LISTEN_FDS" ]; then
+        BIND="--fd 3"
+    else
+        BIND="--host $API_HOST --port $API_PORT"
+    fi
+
+    echo "Запуск FastAPI сервера (production): $API_WORKERS воркеров, $BIND"
+    echo "Пул соединений с БД на каждый воркер: до ${DB_POOL_MAX_SIZE:-20}"
+    # Кэш каталога у каждого воркера свой: сброс после записи в одном воркере доходит
+    # до остальных через БД в течение CATALOG_CACHE_SYNC_INTERVAL секунд (по умолчанию 1)
+    # Журнал запросов пишет само приложение (RequestContextMiddleware), access log uvicorn не нужен.
+    # WORKER_READY_TIMEOUT должен покрывать запуск воркера вместе с прогревом (WARMUP_TIMEOUT),
+    # иначе перезапуск по SIGHUP отменяется и старые воркеры продолжают работу.
+    exec uvicorn api:app $BIND \
+        --workers "$API_WORKERS" \
+        --timeout-graceful-shutdown "${GRACEFUL_TIMEOUT:-30}" \
+        --timeout-worker-healthcheck "${WORKER_READY_TIMEOUT:-60}" \
+        --timeout-keep-alive "${KEEPALIVE_TIMEOUT:-5}" \
+        --no-access-log
+fi
+
 # Запуск API
-echo "Запуск FastAPI сервера на порту 8000..."
-uvicorn api:app --host 0.0.0.0 --port 8000 --reload
+echo "Запуск FastAPI сервера на порту $API_PORT..."
+export DB_AUTO_MIGRATE="${DB_AUTO_MIGRATE:-true}"
+exec uvicorn api:app --host "$API_HOST" --port "$API_PORT" --reload
@@ -0,0 +1,107 @@
+"""
+run_db keeps the event loop free: while one request waits on a slow query
+in the DB executor, other requests are still served.
+"""
+import asyncio
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import httpx
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import api  # noqa: E402
+
+
+class FakeCursor:
+    def __init__(self, connection):
+        self.connection = connection
+        self._rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, query, vars=None, name=None):
+        if name == "categories":
+            # The "long query": holds its DB thread until the test releases it
+            self.connection.slow_started.set()
+            assert self.connection.release_slow.wait(10), "slow query was never released"
+            self._rows = [{"id": 1, "name": "Slow", "description": None, "created_at": None, "products_count": 0}]
+        else:
+            self._rows = [{"id": 1, "name": "Fast", "description": None, "created_at": None, "products_count": 0}]
+
+    def fetchall(self):
+        return self._rows
+
+
+class FakeConnection:
+    def __init__(self):
+        self.slow_started = threading.Event()
+        self.release_slow = threading.Event()
+
+    def cursor(self, cursor_factory=None):
+        return FakeCursor(self)
+
+
+@pytest.fixture
+def fake_db(monkeypatch):
+    conn = FakeConnection()
+
+    @contextmanager
+    def db_connection(replica=False):
+        yield conn
+
+    executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="db")
+    monkeypatch.setattr(api, "db_connection", db_connection)
+    monkeypatch.setattr(api, "db_executor", executor)
+    api.catalog_cache.clear()
+    try:
+        yield conn
+    finally:
+        conn.release_slow.set()
+        executor.shutdown(wait=True)
+        api.catalog_cache.clear()
+
+
+def test_request_completes_while_long_query_in_flight(fake_db):
+    async def scenario():
+        transport = httpx.ASGITransport(app=api.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            slow = asyncio.ensure_future(client.get("/api/categories"))
+            assert await asyncio.to_thread(fake_db.slow_started.wait, 5), "slow query did not start"
+
+            fast = await asyncio.wait_for(client.get("/api/brands"), timeout=5)
+            assert fast.status_code == 200
+            assert fast.json()[0]["name"] == "Fast"
+            assert not slow.done(), "the slow request should still be waiting on its query"
+
+            fake_db.release_slow.set()
+            slow_response = await asyncio.wait_for(slow, timeout=5)
+            assert slow_response.status_code == 200
+            assert slow_response.json()[0]["name"] == "Slow"
+
+    asyncio.run(scenario())
+
+
+def test_run_db_calls_overlap(fake_db):
+    async def scenario():
+        def blocking(seconds):
+            fake_db.release_slow.wait(seconds)
+            return threading.current_thread().name
+
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        names = await asyncio.gather(*(api.run_db(blocking, 0.3) for _ in range(4)))
+        elapsed = loop.time() - started
+        # Four 0.3s calls on four DB threads take about 0.3s, not 1.2s
+        assert elapsed < 0.9
+        assert len(set(names)) == 4
+
+    asyncio.run(scenario())
@@ -0,0 +1,274 @@
+"""
+Streamed price lists are parsed in a separate process: the request body goes
+through a pipe, normalized batches come back, and only the DB writes stay in
+the API process.
+"""
+import asyncio
+import gzip
+import json
+import multiprocessing
+import os
+import sys
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import api  # noqa: E402
+
+
+def run_parser_process(chunks, parser, content_encoding="identity", chunk_size=2):
+    """Feed chunks to parse_request_stream in a spawned process and collect its messages"""
+    body_reader, body_writer = multiprocessing.Pipe(duplex=False)
+    results_reader, results_writer = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.get_context("spawn").Process(
+        target=api.parse_request_stream,
+        args=(body_reader, results_writer, parser, content_encoding, chunk_size),
+        daemon=True,
+    )
+    process.start()
+    body_reader.close()
+    results_writer.close()
+    for chunk in chunks:
+        body_writer.send_bytes(chunk)
+    body_writer.send_bytes(b"")
+
+    messages = []
+    while True:
+        message = results_reader.recv()
+        messages.append(message)
+        if message[0] in ("done", "error"):
+            break
+    process.join(10)
+    body_writer.close()
+    results_reader.close()
+    return messages
+
+
+def ndjson(*items):
+    return b"".join(json.dumps(item, ensure_ascii=False).encode() + b"\n" for item in items)
+
+
+def test_gzipped_ndjson_is_parsed_and_normalized_in_batches():
+    body = gzip.compress(ndjson(
+        {"name": "Кран", "sku": "A1", "price": "1 299,50", "stock_quantity": "3"},
+        {"name": "Смеситель", "sku": "A2", "price": 10},
+        {"name": "Труба", "sku": "A3", "price": 5},
+    ) + b"not json\n")
+    # Chunk boundaries fall inside records
+    chunks = [body[i:i + 7] for i in range(0, len(body), 7)]
+
+    messages = run_parser_process(chunks, api.iter_ndjson_products, "gzip", chunk_size=2)
+
+    assert messages[-1] == ("done",)
+    batches = [(rows, errors) for kind, rows, errors in messages[:-1]]
+    assert [len(rows) for rows, _ in batches] == [2, 1]
+    assert sum(errors for _, errors in batches) == 1
+    assert batches[0][0][0]["price"] == 1299.5
+    assert batches[0][0][0]["stock_quantity"] == 3
+
+
+def test_parse_error_is_sent_back():
+    messages = run_parser_process(["<root><Товар><Наименование>x</Наименование>".encode()], api.iter_1c_xml_products)
+
+    kind, error = messages[-1]
+    assert kind == "error"
+    assert isinstance(error, ET.ParseError)
+
+
+@pytest.fixture
+def fake_jobs(monkeypatch):
+    written = []
+
+    def sync_products(rows, normalized=False):
+        assert normalized
+        written.append(rows)
+        return {"processed": len(rows), "created": len(rows), "updated": 0, "unchanged": 0, "errors": 0}
+
+    def normalize_products(products):
+        raise AssertionError("the API process must not parse or normalize streamed uploads")
+
+    executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="db")
+    monkeypatch.setattr(api, "db_executor", executor)
+    monkeypatch.setattr(api, "sync_products", sync_products)
+    monkeypatch.setattr(api, "normalize_products", normalize_products)
+    monkeypatch.setattr(api, "create_sync_job", lambda *args: {"id": 1, "status": "queued", "duplicate": False})
+    monkeypatch.setattr(api, "try_lock_sync_source", lambda source: object())
+    monkeypatch.setattr(api, "unlock_sync_source", lambda conn, source: None)
+    monkeypatch.setattr(api, "start_sync_job", lambda job_id: None)
+    monkeypatch.setattr(api, "record_sync_job_progress", lambda *args: None)
+    monkeypatch.setattr(api, "finish_sync_job", lambda job_id, result: None)
+    monkeypatch.setattr(api, "fail_sync_job", lambda job_id, error: None)
+    monkeypatch.setattr(api, "log_sync_result", lambda *args: None)
+    try:
+        yield written
+    finally:
+        executor.shutdown(wait=True)
+        api.close_parse_executor()
+
+
+def test_stream_webhook_writes_batches_parsed_in_another_process(fake_jobs):
+    body = ndjson(*({"name": f"Товар {i}", "sku": f"S{i}", "price": i} for i in range(5)))
+
+    async def scenario():
+        transport = httpx.ASGITransport(app=api.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test", timeout=30) as client:
+            return await client.post(
+                "/webhook/price-list/stream?chunk_size=2",
+                content=body,
+                headers={"Content-Type": "application/x-ndjson"},
+            )
+
+    response = asyncio.run(scenario())
+
+    assert response.status_code == 200, response.text
+    assert response.json()["created"] == 5
+    assert [len(rows) for rows in fake_jobs] == [2, 2, 1]
+
+
+def test_stream_webhook_reports_parse_errors_as_400(fake_jobs):
+    async def scenario():
+        transport = httpx.ASGITransport(app=api.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test", timeout=30) as client:
+            return await client.post(
+                "/webhook/price-list/xml",
+                content="<root><Товар>".encode(),
+                headers={"Content-Type": "application/xml"},
+            )
+
+    response = asyncio.run(scenario())
+
+    assert response.status_code == 400
+    # The parse slot is given back
+    assert not api.parse_slots.locked()
+
+
+def test_stream_webhook_answers_503_when_parse_workers_are_busy(fake_jobs, monkeypatch):
+    async def scenario():
+        monkeypatch.setattr(api, "parse_slots", asyncio.Semaphore(1))
+        await api.parse_slots.acquire()
+        transport = httpx.ASGITransport(app=api.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test", timeout=30) as client:
+            return await client.post(
+                "/webhook/price-list/stream",
+                content=ndjson({"name": "Кран", "sku": "A1", "price": 1}),
+                headers={"Content-Type": "application/x-ndjson"},
+            )
+
+    response = asyncio.run(scenario())
+
+    assert response.status_code == 503
+    assert response.headers["retry-after"]
+    assert fake_jobs == []
+
+
+def test_parse_worker_is_released_when_the_client_disconnects(fake_jobs, monkeypatch):
+    monkeypatch.setattr(api, "PARSE_PROCESSES", 1)
+    monkeypatch.setattr(api, "parse_slots", None)
+    api.close_parse_executor()
+
+    async def broken_body():
+        yield ndjson({"name": "Кран", "sku": "A1", "price": 1})
+        raise ConnectionResetError("client went away")
+
+    async def scenario():
+        transport = httpx.ASGITransport(app=api.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test", timeout=30) as client:
+            failed = await client.post("/webhook/price-list/stream", content=broken_body(),
+                                       headers={"Content-Type": "application/x-ndjson"})
+            assert failed.status_code == 500
+            # The only parse worker must be free again for the next upload
+            return await asyncio.wait_for(client.post(
+                "/webhook/price-list/stream",
+                content=ndjson({"name": "Смеситель", "sku": "A2", "price": 2}),
+                headers={"Content-Type": "application/x-ndjson"},
+            ), timeout=20)
+
+    response = asyncio.run(scenario())
+
+    assert response.status_code == 200, response.text
+    assert response.json()["created"] == 1
+
+
+class FakeShardConnection:
+    closed = False
+
+    def cursor(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def commit(self):
+        pass
+
+
+def test_sharded_price_list_is_partitioned_by_the_parse_worker(monkeypatch, tmp_path):
+    # The parse worker is spawned and reads its settings from the environment
+    monkeypatch.setenv("INGEST_SHARD_MIN_ROWS", "1")
+    monkeypatch.setenv("INGEST_SPILL_DIR", str(tmp_path))
+    monkeypatch.setattr(api, "INGEST_SHARDS", 3)
+    monkeypatch.setattr(api, "INGEST_CHUNK_SIZE", 2)
+    items = [{"Наименование": f"Товар {i}", "Артикул": f"S{i}", "Цена": i} for i in range(10)]
+    items.append({"Наименование": "Товар 1", "Артикул": "S1", "Цена": 100})
+    items.append({"Наименование": "Без цены", "Артикул": "S99", "Цена": "по запросу"})
+    body = json.dumps({"products": items}).encode()
+
+    chunks = {}
+    sync_shard_chunk = api.sync_shard_chunk
+
+    def record_chunk(path, offset, length, category_ids, brand_ids):
+        chunks.setdefault(os.path.basename(path), []).append(offset)
+        return sync_shard_chunk(path, offset, length, category_ids, brand_ids)
+
+    written = []
+
+    def upsert_products_isolated(cursor, rows, category_ids, brand_ids):
+        assert {row["category"] for row in rows} <= set(category_ids)
+        written.extend(rows)
+        return len(rows), 0, 0, 0
+
+    executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="db")
+    monkeypatch.setattr(api, "db_executor", executor)
+    monkeypatch.setattr(api, "get_ingest_executor", lambda shards: executor)
+    monkeypatch.setattr(api, "_shard_connection", FakeShardConnection())
+    monkeypatch.setattr(api, "sync_shard_chunk", record_chunk)
+    monkeypatch.setattr(api, "upsert_products_isolated", upsert_products_isolated)
+    monkeypatch.setattr(api, "resolve_shard_dictionaries",
+                        lambda categories, brands: ({name: 1 for name in categories}, {name: 1 for name in brands}))
+    monkeypatch.setattr(api, "log_sync_result", lambda *args, **kwargs: None)
+    try:
+        result = asyncio.run(api.process_price_list(body))
+    finally:
+        executor.shutdown(wait=True)
+        api.close_parse_executor()
+
+    assert result["created"] == 11
+    assert result["errors"] == 1
+    assert len(chunks) > 1
+    assert set(chunks) <= {"shard-0.pickle", "shard-1.pickle", "shard-2.pickle"}
+    # Both rows of S1 went to one shard, in payload order
+    assert [row["price"] for row in written if row["sku"] == "S1"] == [1.0, 100.0]
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_empty_alias_does_not_hide_a_filled_one():
+    record = {"Наименование": "Кран", "Артикул": "", "sku": "A1", "Цена": "", "price": "10"}
+    row = {"Наименование": "Смеситель", "Артикул": "A2", "sku": "", "Цена": "5"}
+
+    products = list(api.extract_products([record, row]))
+
+    assert products[0]["sku"] == "A1"
+    assert products[0]["price"] == "10"
+    assert products[1]["sku"] == "A2"
+
+    extract = api.compile_row_extractor(["Наименование", "Артикул", "sku", "Цена"])
+    assert extract(["Кран", "", "A1", "10"])["sku"] == "A1"
+    assert extract(["Кран", "A2"])["sku"] == "A2"
+    assert extract(["Кран", "", ""])["sku"] == ""